@@ -9,4 +9,7 @@ __author__ = 'Dennis Iversen'
 __credits__ = '10kilobyte.com'
 
 from .sqlite_object import SQLiteObject, get_sqlite_object
-from .sql_query import SQLQuery
\ No newline at end of file
+from .sql_query import SQLQuery
+from .maintenance import SQLiteMaintenance
+from .sharded import ShardedSQLiteObject
+from .query_plan import QueryPlanGuard, QueryPlanError
\ No newline at end of file
@@ -0,0 +1,202 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class SQLiteMaintenance:
+    """
+    Runs WAL checkpoints, PRAGMA optimize (or ANALYZE) and incremental vacuum
+    on its own connection when configurable thresholds are reached
+    """
+
+    def __init__(
+        self,
+        db_path,
+        wal_size_limit=4 * 1024 * 1024,
+        write_limit=1000,
+        idle_time=30.0,
+        full_analyze=False,
+        vacuum_pages=0,
+        busy_timeout=0.1,
+    ):
+        self.db_path = db_path
+        self.wal_size_limit = wal_size_limit
+        self.write_limit = write_limit
+        self.idle_time = idle_time
+        self.full_analyze = full_analyze
+        self.vacuum_pages = vacuum_pages
+
+        # A TRUNCATE checkpoint holds the write lock while it waits for readers,
+        # so keep the busy timeout short to not block the application's writes
+        self.connection = sqlite3.connect(
+            db_path, timeout=busy_timeout, check_same_thread=False
+        )
+        # 'connection_lock' serializes the maintenance steps. 'counter_lock' is only
+        # held briefly, so record_write() never waits for a running step
+        self.connection_lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        self.writes_since_optimize = 0
+        self.idle_run_pending = False
+        self.last_write_at = time.monotonic()
+        self.last_report = {}
+        self.last_error = None
+        self.run_count = 0
+
+    def close(self) -> None:
+        self.stop()
+        with self.connection_lock:
+            self.connection.close()
+
+    def record_write(self, num_writes=1) -> None:
+        with self.counter_lock:
+            self.writes_since_optimize += num_writes
+            self.idle_run_pending = True
+            self.last_write_at = time.monotonic()
+
+    def get_wal_size(self) -> int:
+        try:
+            return os.path.getsize(f"{self.db_path}-wal")
+        except OSError:
+            return 0
+
+    def get_free_bytes(self) -> int:
+        page_size = self.connection.execute("PRAGMA page_size").fetchone()[0]
+        free_pages = self.connection.execute("PRAGMA freelist_count").fetchone()[0]
+        return page_size * free_pages
+
+    def is_idle(self) -> bool:
+        with self.counter_lock:
+            idle_for = time.monotonic() - self.last_write_at
+            return self.idle_run_pending and idle_for >= self.idle_time
+
+    def get_due_steps(self) -> list:
+        """Returns the maintenance steps where a threshold has been reached"""
+        steps = []
+        idle = self.is_idle()
+        if idle or self.get_wal_size() >= self.wal_size_limit:
+            steps.append("checkpoint")
+        if self.writes_since_optimize >= self.write_limit:
+            steps.append("optimize")
+        if idle:
+            steps.append("incremental_vacuum")
+        return steps
+
+    def checkpoint(self, mode="PASSIVE") -> dict:
+        wal_size = self.get_wal_size()
+        start = time.monotonic()
+        busy, log_frames, checkpointed = self.connection.execute(
+            f"PRAGMA wal_checkpoint({mode})"
+        ).fetchone()
+        return {
+            "mode": mode,
+            "duration": time.monotonic() - start,
+            "reclaimed_bytes": wal_size - self.get_wal_size(),
+            "busy": bool(busy),
+            "log_frames": log_frames,
+            "checkpointed_frames": checkpointed,
+        }
+
+    def optimize(self) -> dict:
+        with self.counter_lock:
+            writes = self.writes_since_optimize
+
+        start = time.monotonic()
+        if self.full_analyze:
+            self.connection.execute("ANALYZE")
+        else:
+            self.connection.execute("PRAGMA optimize")
+
+        # Keep the writes done while optimizing
+        with self.counter_lock:
+            self.writes_since_optimize -= writes
+        return {"duration": time.monotonic() - start}
+
+    def incremental_vacuum(self) -> dict:
+        """
+        Free pages are only reclaimed if the database uses
+        PRAGMA auto_vacuum = INCREMENTAL
+        """
+        free_bytes = self.get_free_bytes()
+        start = time.monotonic()
+        sql = "PRAGMA incremental_vacuum"
+        if self.vacuum_pages:
+            sql += f"({int(self.vacuum_pages)})"
+        self.connection.execute(sql).fetchall()
+        return {
+            "duration": time.monotonic() - start,
+            "reclaimed_bytes": free_bytes - self.get_free_bytes(),
+        }
+
+    def run(self, steps=None) -> dict:
+        """
+        Run the given steps ('checkpoint', 'optimize', 'incremental_vacuum'),
+        or all of them. Returns a report with the result of each step
+        """
+        if steps is None:
+            steps = ["checkpoint", "optimize", "incremental_vacuum"]
+
+        report = {}
+        with self.connection_lock:
+            last_write_at = self.last_write_at
+            idle = self.is_idle()
+            for step in steps:
+                if step == "checkpoint":
+                    report[step] = self.checkpoint("TRUNCATE" if idle else "PASSIVE")
+                elif step == "optimize":
+                    report[step] = self.optimize()
+                elif step == "incremental_vacuum":
+                    report[step] = self.incremental_vacuum()
+                else:
+                    raise Exception(f"Unknown maintenance step: {step}")
+            # Writes done while running need another idle run
+            with self.counter_lock:
+                if idle and self.last_write_at == last_write_at:
+                    self.idle_run_pending = False
+
+        if report:
+            self.last_report = report
+            self.run_count += 1
+        return report
+
+    def run_if_needed(self) -> dict:
+        return self.run(self.get_due_steps())
+
+    def start(self, interval=5.0) -> "SQLiteMaintenance":
+        """Check the thresholds every 'interval' seconds in a background thread"""
+        if self.thread:
+            return self
+
+        def loop():
+            while not self.stop_event.wait(interval):
+                try:
+                    self.run_if_needed()
+                except sqlite3.Error as e:
+                    # e.g. 'database is locked'. Try again on the next interval
+                    self.last_error = e
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def get_stats(self) -> dict:
+        return {
+            "wal_size": self.get_wal_size(),
+            "writes_since_optimize": self.writes_since_optimize,
+            "run_count": self.run_count,
+            "last_report": self.last_report,
+            "last_error": self.last_error,
+        }
+
+
+__all__ = ["SQLiteMaintenance"]
@@ -0,0 +1,197 @@
+import os
+import re
+import sqlite3
+import sys
+import warnings
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_caller_stacklevel() -> int:
+    """
+    Returns the stacklevel, relative to the calling function, of the first frame
+    outside this package. Used to point warnings at the code calling SQLiteObject
+    """
+    level = 1
+    frame = sys._getframe(1)
+    while frame.f_back:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if os.path.dirname(filename) != package_dir:
+            break
+        frame = frame.f_back
+        level += 1
+    return level
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+table_pattern = re.compile(
+    r"(?:\b(?:FROM|JOIN|UPDATE|INTO)|,)\s+([\w.\"`\[\]]+)"
+    r"(?:\s+(?:AS\s+)?([\w\"`\[\]]+))?",
+    re.IGNORECASE,
+)
+cte_pattern = re.compile(
+    r"(?:\bWITH\s+(?:RECURSIVE\s+)?|,)\s*(\w+)\s+AS\s*\(", re.IGNORECASE
+)
+keywords = set(
+    "AS CROSS EXCEPT FROM FULL GROUP HAVING INDEXED INNER INTERSECT JOIN LEFT LIMIT "
+    "NATURAL NOT ON ORDER OUTER RETURNING RIGHT SELECT SET UNION USING VALUES WHERE "
+    "WINDOW".split()
+)
+
+
+def unquote(name: str) -> str:
+    return name.strip('"`[]')
+
+
+class QueryPlanGuard:
+    """
+    Runs EXPLAIN QUERY PLAN once per distinct SQL statement and raises, warns or
+    counts when the plan contains a full table scan or a temp B-tree used for
+    ORDER BY on a table with at least 'min_rows' rows. Row counts are checked
+    each time the statement runs, so tables growing after the first run are caught
+    """
+
+    modes = ["raise", "warn", "count"]
+    statements = ("SELECT", "UPDATE", "DELETE", "WITH")
+
+    def __init__(self, mode="raise", min_rows=1000):
+        if mode not in self.modes:
+            raise Exception(f"Unknown plan guard mode: {mode}")
+
+        self.mode = mode
+        self.min_rows = min_rows
+        self.plans = {}
+        self.flagged_statements = {}
+        self.row_counts = {}
+        self.row_counts_version = None
+        self.num_checked = 0
+        self.num_flagged = 0
+
+    def get_table_names(self, query) -> dict:
+        """Returns a dict of the table names and aliases in 'query' and their tables"""
+        names = {}
+        for table, alias in table_pattern.findall(query):
+            table = ".".join(unquote(part) for part in table.split("."))
+            if table.upper() in keywords or table.startswith("("):
+                continue
+            names.setdefault(table, table)
+            if alias and alias.upper() not in keywords:
+                names[unquote(alias)] = table
+        for cte in cte_pattern.findall(query):
+            names[cte] = None
+        return names
+
+    def get_plan(
+        self, connection: sqlite3.Connection, query, placeholder_values=None
+    ) -> dict:
+        """
+        Returns the full table scans and temp B-trees of the plan. Each scan is a
+        tuple of (detail, name in the plan, table)
+        """
+        rows = connection.execute(
+            f"EXPLAIN QUERY PLAN {query}", placeholder_values or []
+        ).fetchall()
+        names = self.get_table_names(query)
+
+        plan = {"scans": [], "tables": set(), "temp_b_trees": []}
+        for row in rows:
+            detail = row[-1]
+            words = detail.split()
+            if words[0] in ("SCAN", "SEARCH") and len(words) > 1:
+                name = words[2] if words[1] == "TABLE" else words[1]
+                if name == "CONSTANT" or name.startswith("("):
+                    # 'SCAN CONSTANT ROW' or a subquery
+                    continue
+                table = names.get(name, name)
+                if table is None:
+                    # A common table expression
+                    continue
+                plan["tables"].add(table)
+                if words[0] == "SCAN" and "INDEX" not in words:
+                    plan["scans"].append((detail, name, table))
+            elif detail.startswith("USE TEMP B-TREE FOR ORDER BY"):
+                plan["temp_b_trees"].append(detail)
+        return plan
+
+    def get_row_count(self, connection: sqlite3.Connection, table):
+        """
+        Returns the number of rows in 'table', or None if it can not be counted.
+        Counts below 'min_rows' are cached until the database changes, so only
+        small tables are counted again
+        """
+        version = (
+            connection.total_changes,
+            connection.execute("PRAGMA data_version").fetchone()[0],
+        )
+        if version != self.row_counts_version:
+            self.row_counts = {
+                name: count
+                for name, count in self.row_counts.items()
+                if count is not None and count >= self.min_rows
+            }
+            self.row_counts_version = version
+
+        if table not in self.row_counts:
+            quoted = ".".join(f'"{part}"' for part in table.split("."))
+            try:
+                sql = f"SELECT COUNT(*) FROM {quoted}"
+                self.row_counts[table] = connection.execute(sql).fetchone()[0]
+            except sqlite3.Error:
+                self.row_counts[table] = None
+        return self.row_counts[table]
+
+    def get_plan_problems(self, connection: sqlite3.Connection, plan: dict) -> list:
+        problems = []
+        for detail, name, table in plan["scans"]:
+            row_count = self.get_row_count(connection, table)
+            if row_count is None:
+                # Do not hide scans of names that could not be resolved
+                problems.append(f"{detail} (unknown table '{name}')")
+            elif row_count >= self.min_rows:
+                problems.append(detail)
+
+        if plan["temp_b_trees"]:
+            row_counts = [
+                self.get_row_count(connection, table) for table in plan["tables"]
+            ]
+            max_rows = max([count or 0 for count in row_counts], default=0)
+            if max_rows >= self.min_rows:
+                problems += plan["temp_b_trees"]
+        return problems
+
+    def check(self, connection: sqlite3.Connection, query, placeholder_values=None):
+        """
+        Check a statement before it is executed. The plan is cached per statement,
+        the row counts are checked on each call
+        """
+        if not query.lstrip().upper().startswith(self.statements):
+            return
+
+        if query not in self.plans:
+            self.plans[query] = self.get_plan(connection, query, placeholder_values)
+
+        self.num_checked += 1
+        problems = self.get_plan_problems(connection, self.plans[query])
+        if not problems:
+            return
+
+        self.num_flagged += 1
+        self.flagged_statements[query] = problems
+        message = f"Query plan problem: {', '.join(problems)} in: {query}"
+        if self.mode == "raise":
+            raise QueryPlanError(message)
+        if self.mode == "warn":
+            warnings.warn(message, stacklevel=get_caller_stacklevel())
+
+    def get_stats(self) -> dict:
+        return {
+            "checked": self.num_checked,
+            "flagged": self.num_flagged,
+            "flagged_statements": dict(self.flagged_statements),
+        }
+
+
+__all__ = ["QueryPlanGuard", "QueryPlanError"]
@@ -0,0 +1,179 @@
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from sqlite_object.sqlite_object import SQLiteObject
+
+
+class ShardedSQLiteObject:
+    """
+    Spreads rows over a number of SQLite files. Rows are routed by hashing the
+    value of 'shard_key' found in the 'values' or 'where' dicts. Queries without
+    the shard key are run on all shards in parallel and the results are merged.
+
+    Each shard has its own worker thread that owns the shard's connection, so
+    calls on a shard are serialized while different shards run concurrently.
+    """
+
+    def __init__(self, db_paths: list, shard_key: str):
+        if not db_paths:
+            raise Exception("At least one db_path is needed")
+
+        self.shard_key = shard_key
+        self.table = None
+        self.last_shard = 0
+        self.executors = [ThreadPoolExecutor(max_workers=1) for _ in db_paths]
+        self.shards = [
+            executor.submit(SQLiteObject, db_path).result()
+            for executor, db_path in zip(self.executors, db_paths)
+        ]
+
+    def close(self) -> None:
+        self.run_all(lambda shard: shard.close())
+        for executor in self.executors:
+            executor.shutdown()
+
+    def set_table(self, table) -> "ShardedSQLiteObject":
+        self.table = table
+        for shard in self.shards:
+            shard.set_table(table)
+        return self
+
+    def get_shard_index(self, key_value) -> int:
+        """Returns the shard index for a key value. Stable across processes"""
+        digest = zlib.crc32(str(key_value).encode("utf-8"))
+        return digest % len(self.shards)
+
+    def get_shard_index_from_dict(self, data: dict):
+        """Returns the shard index if the shard key is in 'data', otherwise None"""
+        if data and self.shard_key in data:
+            return self.get_shard_index(data[self.shard_key])
+        return None
+
+    def run_on_shard(self, index, func):
+        """Run 'func(sqlite_object)' in the thread owning the shard"""
+        self.last_shard = index
+        return self.executors[index].submit(func, self.shards[index]).result()
+
+    def run_all(self, func) -> list:
+        """Run 'func(sqlite_object)' on all shards in parallel"""
+        futures = [
+            executor.submit(func, shard)
+            for executor, shard in zip(self.executors, self.shards)
+        ]
+        return [future.result() for future in futures]
+
+    def shard_execute(self, key_value, func):
+        """
+        Run 'func(sqlite_object)' on the shard holding 'key_value', e.g. to run
+        in_transaction_execute on a single shard
+        """
+        return self.run_on_shard(self.get_shard_index(key_value), func)
+
+    def execute_all(self, query, placeholder_values=None) -> None:
+        """Execute a query (e.g. CREATE TABLE) on all shards"""
+        self.run_all(lambda shard: shard.execute_commit(query, placeholder_values))
+
+    def insert_id(self) -> int:
+        """Last insert id on the last used shard. Ids are not unique across shards"""
+        return self.run_on_shard(self.last_shard, lambda shard: shard.insert_id())
+
+    def sort_key(self, value) -> tuple:
+        """Order values like SQLite: NULL, then numbers, then text, then BLOBs"""
+        if value is None:
+            return (0, 0)
+        if isinstance(value, (int, float)):
+            return (1, value)
+        if isinstance(value, str):
+            return (2, value)
+        return (3, bytes(value))
+
+    def sort_rows(self, rows: list, order_by: list = None) -> list:
+        if not order_by:
+            return rows
+
+        # Sort on the last column first. Python's sort is stable
+        for column, direction in reversed(order_by):
+            rows.sort(
+                key=lambda row: self.sort_key(row[column]),
+                reverse=direction.upper() == "DESC",
+            )
+        return rows
+
+    def insert(self, values: dict) -> None:
+        index = self.get_shard_index_from_dict(values)
+        if index is None:
+            raise Exception(f"Shard key '{self.shard_key}' is missing in values")
+        self.run_on_shard(index, lambda shard: shard.insert(values))
+
+    def update_simple(self, values: dict, where: dict) -> None:
+        if self.shard_key in values:
+            raise Exception(f"Shard key '{self.shard_key}' can not be updated")
+
+        index = self.get_shard_index_from_dict(where)
+        if index is None:
+            self.run_all(lambda shard: shard.update_simple(values, where))
+        else:
+            self.run_on_shard(index, lambda shard: shard.update_simple(values, where))
+
+    def delete_simple(self, where: dict) -> None:
+        index = self.get_shard_index_from_dict(where)
+        if index is None:
+            self.run_all(lambda shard: shard.delete_simple(where))
+        else:
+            self.run_on_shard(index, lambda shard: shard.delete_simple(where))
+
+    def fetchone_simple(
+        self, columns="*", where=None, order_by=None, limit=None
+    ) -> dict:
+        """
+        Fetch one row. If the shard key is not in 'where' all shards are queried
+        and the first row according to 'order_by' and 'limit' is returned
+        """
+        index = self.get_shard_index_from_dict(where)
+        if index is not None:
+            return self.run_on_shard(
+                index,
+                lambda shard: shard.fetchone_simple(columns, where, order_by, limit),
+            )
+
+        # Only the row at the offset is needed from the merged rows
+        offset = limit[0] if limit else 0
+        rows = self.fetchall_simple(columns, where, order_by, [offset, 1])
+        return rows[0] if rows else None
+
+    def fetchall_simple(
+        self, columns="*", where=None, order_by=None, limit=None
+    ) -> list:
+        """
+        Fetch rows from the shard holding the shard key, or from all shards merged.
+        Columns used in 'order_by' must be part of 'columns' when merging
+        """
+        index = self.get_shard_index_from_dict(where)
+        if index is not None:
+            return self.run_on_shard(
+                index,
+                lambda shard: shard.fetchall_simple(columns, where, order_by, limit),
+            )
+
+        # Each shard returns the first offset + count rows, then the merged rows are sliced
+        shard_limit = None
+        if limit:
+            shard_limit = [0, limit[0] + limit[1]]
+
+        results = self.run_all(
+            lambda shard: shard.fetchall_simple(columns, where, order_by, shard_limit)
+        )
+        rows = self.sort_rows([row for result in results for row in result], order_by)
+        if limit:
+            rows = rows[limit[0] : limit[0] + limit[1]]
+        return rows
+
+    def get_num_rows(self, where=None, column="*") -> int:
+        index = self.get_shard_index_from_dict(where)
+        if index is not None:
+            return self.run_on_shard(
+                index, lambda shard: shard.get_num_rows(where, column)
+            )
+        return sum(self.run_all(lambda shard: shard.get_num_rows(where, column)))
+
+
+__all__ = ["ShardedSQLiteObject"]
@@ -1,23 +1,130 @@
+import os
+import random
 import sqlite3
+import time
 from sqlite3 import Error
 from sqlite_object.sql_query import SQLQuery
+from sqlite_object.maintenance import SQLiteMaintenance
+from sqlite_object.query_plan import QueryPlanGuard
+
+
+def is_busy_error(e: Exception) -> bool:
+    """SQLITE_BUSY or SQLITE_LOCKED, including extended error codes"""
+    if not isinstance(e, sqlite3.OperationalError):
+        return False
+    code = getattr(e, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(e) or "busy" in str(e)
 
 
 class SQLiteObject:
-    def __init__(self, db_path):
+    def __init__(
+        self,
+        db_path,
+        read_replica=False,
+        replica_refresh_interval=None,
+        busy_timeout=5.0,
+        busy_retries=0,
+        busy_backoff=0.01,
+        busy_backoff_max=1.0,
+    ):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.busy_retries = busy_retries
+        self.busy_backoff = busy_backoff
+        self.busy_backoff_max = busy_backoff_max
+        self.busy_stats = {
+            "busy_errors": 0,
+            "retries": 0,
+            "transaction_retries": 0,
+            "wait_time": 0.0,
+        }
         self.connection = self.get_connection(db_path)
         self.cursor = None
         self.auto_commit = True
         self.table = None
 
+        self.replica = None
+        self.replica_refresh_interval = replica_refresh_interval
+        self.replica_refreshed_at = None
+        self.replica_refresh_count = 0
+        self.replica_refresh_duration = 0.0
+        self.replica_writes_since_refresh = 0
+        self.maintenance = None
+        self.plan_guard = None
+        if read_replica:
+            self.enable_read_replica()
+
     def get_connection(self, db_path) -> sqlite3.Connection:
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(db_path, timeout=self.busy_timeout)
         conn.row_factory = sqlite3.Row
         return conn
 
     def close(self) -> None:
+        if self.maintenance:
+            self.maintenance.close()
+            self.maintenance = None
+        if self.replica:
+            self.replica.close()
+            self.replica = None
         self.connection.close()
 
+    def enable_read_replica(self) -> "SQLiteObject":
+        """
+        Load the database into an in-memory replica. All fetch* calls are served
+        from the replica while writes go to the primary connection
+        """
+        if not self.replica:
+            self.replica = self.get_connection(":memory:")
+            # Writes sent to the replica by mistake raise instead of being lost
+            self.replica.execute("PRAGMA query_only = ON")
+            self.refresh_replica()
+        return self
+
+    def disable_read_replica(self) -> "SQLiteObject":
+        if self.replica:
+            self.replica.close()
+            self.replica = None
+        return self
+
+    def refresh_replica(self, pages=-1) -> None:
+        """
+        Copy the primary database into the replica using the backup API.
+        If 'pages' is positive the copy is done in steps of that many pages,
+        releasing the lock on the primary between steps
+        """
+        if not self.replica:
+            raise Exception("No read replica. Use enable_read_replica() first.")
+
+        start = time.monotonic()
+        self.connection.backup(self.replica, pages=pages)
+        self.replica_refresh_duration = time.monotonic() - start
+        self.replica_refreshed_at = time.time()
+        self.replica_refresh_count += 1
+        self.replica_writes_since_refresh = 0
+
+    def replica_is_stale(self) -> bool:
+        """Returns True if the replica is older than 'replica_refresh_interval'"""
+        if not self.replica or self.replica_refresh_interval is None:
+            return False
+        age = time.time() - self.replica_refreshed_at
+        return age >= self.replica_refresh_interval
+
+    def get_replica_stats(self) -> dict:
+        enabled = self.replica is not None
+        staleness = None
+        if enabled:
+            staleness = time.time() - self.replica_refreshed_at
+        return {
+            "enabled": enabled,
+            "refreshed_at": self.replica_refreshed_at,
+            "staleness_seconds": staleness,
+            "writes_since_refresh": self.replica_writes_since_refresh,
+            "refresh_count": self.replica_refresh_count,
+            "last_refresh_duration": self.replica_refresh_duration,
+        }
+
     def set_table(self, table) -> "SQLiteObject":
         self.table = table
         return self
@@ -27,38 +134,255 @@ class SQLiteObject:
             raise Exception("No table set. Use set_table() first.")
         return self.table
 
+    def enable_plan_guard(self, mode="raise", min_rows=1000) -> QueryPlanGuard:
+        """
+        Check the query plan of each distinct statement. 'mode' is 'raise', 'warn'
+        or 'count'. Full table scans and temp B-trees for ORDER BY are flagged on
+        tables with at least 'min_rows' rows
+        """
+        self.plan_guard = QueryPlanGuard(mode, min_rows)
+        return self.plan_guard
+
     def execute(self, query, placeholder_values=None) -> sqlite3.Cursor:
         # with self.connection:
-        self.cursor = self.connection.cursor()
-        self.cursor.execute(query, placeholder_values or [])
-        return self.cursor
+        if self.plan_guard:
+            self.plan_guard.check(self.connection, query, placeholder_values)
+
+        in_transaction = self.connection.in_transaction
+
+        def run():
+            self.cursor = self.connection.cursor()
+            try:
+                self.cursor.execute(query, placeholder_values or [])
+            except Error as e:
+                # Roll back the implicit transaction opened by the failed statement.
+                # In auto commit mode it would otherwise be committed by the next
+                # write. On SQLITE_BUSY this also drops the read snapshot, so a
+                # retry does not fail on a stale snapshot
+                if (self.auto_commit or is_busy_error(e)) and not in_transaction:
+                    if self.connection.in_transaction:
+                        self.connection.rollback()
+                raise
+            return self.cursor
+
+        # Inside in_transaction_execute the whole transaction is retried instead
+        return self.busy_retry(run, retry=self.auto_commit)
+
+    def busy_retry(self, func, retry=True):
+        """
+        Call 'func' and retry it on SQLITE_BUSY up to 'busy_retries' times
+        with jittered exponential backoff
+        """
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                return func()
+            except Error as e:
+                if not is_busy_error(e):
+                    raise
+                self.busy_stats["busy_errors"] += 1
+                self.busy_stats["wait_time"] += time.monotonic() - start
+                if not retry or attempt >= self.busy_retries:
+                    raise
+                self.busy_wait(attempt)
+                attempt += 1
+
+    def busy_wait(self, attempt) -> None:
+        delay = min(self.busy_backoff * 2**attempt, self.busy_backoff_max)
+        delay *= random.random()
+        time.sleep(delay)
+        self.busy_stats["retries"] += 1
+        self.busy_stats["wait_time"] += delay
+
+    def get_busy_stats(self) -> dict:
+        return dict(self.busy_stats)
+
+    def commit(self) -> None:
+        """
+        Commit. A commit failing with SQLITE_BUSY can safely be retried. In auto
+        commit mode a commit still failing is rolled back, so the failed write
+        is not committed later by the next write
+        """
+        try:
+            self.busy_retry(self.connection.commit)
+        except Error:
+            if self.auto_commit:
+                self.connection.rollback()
+            raise
 
     def execute_commit(self, query, placeholder_values=None) -> sqlite3.Cursor:
         # with self.connection:
 
         cursor = self.execute(query, placeholder_values)
         if self.auto_commit:
-            self.connection.commit()
+            self.commit()
+
+        self.record_write()
 
         return cursor
 
+    def record_write(self) -> None:
+        if self.replica:
+            self.replica_writes_since_refresh += 1
+        if self.maintenance:
+            self.maintenance.record_write()
+
+    def enable_maintenance(self, interval=5.0, **kwargs) -> SQLiteMaintenance:
+        """
+        Run WAL checkpoints, PRAGMA optimize and incremental vacuum in a background
+        thread on a separate connection. 'kwargs' are passed to SQLiteMaintenance
+        """
+        if not self.maintenance:
+            self.maintenance = SQLiteMaintenance(self.db_path, **kwargs)
+            self.maintenance.start(interval)
+        return self.maintenance
+
+    def execute_read(self, query, placeholder_values=None) -> sqlite3.Cursor:
+        """
+        Execute a read query. Uses the read replica if enabled. Inside a
+        transaction the primary connection is used, so uncommitted writes are seen.
+        Statements not starting with SELECT or WITH, e.g. INSERT ... RETURNING,
+        also use the primary connection
+        """
+        if not self.replica or not self.auto_commit:
+            return self.execute(query, placeholder_values)
+
+        if not query.lstrip().upper().startswith(("SELECT", "WITH")):
+            return self.execute(query, placeholder_values)
+
+        if self.replica_is_stale():
+            self.refresh_replica()
+
+        if self.plan_guard:
+            self.plan_guard.check(self.connection, query, placeholder_values)
+
+        self.cursor = self.replica.cursor()
+        self.cursor.execute(query, placeholder_values or [])
+        return self.cursor
+
+    def open_blob(self, table, column, rowid, readonly=True) -> "sqlite3.Blob":
+        """
+        Open a BLOB for incremental I/O. Use it as a context manager or close it
+        when done. A BLOB can not change size, so use zeroblob(n) to allocate it
+        """
+        if not hasattr(self.connection, "blobopen"):
+            raise Exception("BLOB streaming requires Python 3.11 or newer")
+        return self.connection.blobopen(table, column, rowid, readonly=readonly)
+
+    def read_blob_range(
+        self, table, column, rowid, offset=0, length=-1, buffer=None, chunk_size=65536
+    ):
+        """
+        Read 'length' bytes of a BLOB starting at 'offset' and return them as bytes.
+        If a writable 'buffer' is given the data is read into it in chunks,
+        and the number of bytes read is returned
+        """
+        with self.open_blob(table, column, rowid) as blob:
+            blob.seek(offset)
+            if buffer is None:
+                return blob.read(length)
+
+            view = memoryview(buffer).cast("B")
+            if length < 0:
+                length = len(blob) - offset
+            length = min(length, len(view))
+
+            num_read = 0
+            while num_read < length:
+                chunk = blob.read(min(chunk_size, length - num_read))
+                if not chunk:
+                    break
+                view[num_read : num_read + len(chunk)] = chunk
+                num_read += len(chunk)
+            return num_read
+
+    def get_stream_size(self, file):
+        """Returns the number of bytes left in a file object, or None if unknown"""
+        try:
+            return os.fstat(file.fileno()).st_size - file.tell()
+        except (AttributeError, OSError, ValueError):
+            pass
+        try:
+            position = file.tell()
+            size = file.seek(0, os.SEEK_END) - position
+            file.seek(position)
+            return size
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def write_blob_stream(
+        self, table, column, rowid, file, offset=0, chunk_size=65536
+    ) -> int:
+        """
+        Write the contents of a binary file object to a BLOB starting at 'offset'
+        in chunks. Returns the number of bytes written. The write is part of the
+        current transaction, e.g. when used in in_transaction_execute
+        """
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+
+        # blobopen does not begin a transaction by itself
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+
+        num_written = 0
+        try:
+            with self.open_blob(table, column, rowid, readonly=False) as blob:
+                size = self.get_stream_size(file)
+                if size is not None and size > len(blob) - offset:
+                    raise ValueError(
+                        f"Stream of {size} bytes does not fit in BLOB of "
+                        f"{len(blob)} bytes at offset {offset}"
+                    )
+
+                blob.seek(offset)
+                while True:
+                    num_read = file.readinto(buffer)
+                    if not num_read:
+                        break
+                    blob.write(view[:num_read])
+                    num_written += num_read
+        except Exception:
+            if self.auto_commit:
+                self.connection.rollback()
+            raise
+
+        if self.auto_commit:
+            self.commit()
+
+        self.record_write()
+
+        return num_written
+
     def insert_id(self) -> int:
         return self.cursor.lastrowid
 
     def rows_affected(self) -> int:
         return self.cursor.rowcount
 
-    def in_transaction_execute(self, func):
-        try:
-            self.auto_commit = False
-            result = func()
-            self.connection.commit()
-            self.auto_commit = True
-            return result
-        except Error as e:
-            self.connection.rollback()
-            self.auto_commit = True
-            raise e
+    def in_transaction_execute(self, func, idempotent=False):
+        """
+        Run 'func' in a single transaction. If 'idempotent' is True the whole
+        transaction is run again on SQLITE_BUSY, up to 'busy_retries' times
+        """
+        attempt = 0
+        while True:
+            try:
+                self.auto_commit = False
+                result = func()
+                self.commit()
+                self.auto_commit = True
+                return result
+            except Error as e:
+                self.connection.rollback()
+                self.auto_commit = True
+                if idempotent and is_busy_error(e) and attempt < self.busy_retries:
+                    self.busy_stats["transaction_retries"] += 1
+                    self.busy_wait(attempt)
+                    attempt += 1
+                    continue
+                raise e
 
     def get_num_rows(self, where=None, column="*") -> int:
         query = SQLQuery()
@@ -66,7 +390,7 @@ class SQLiteObject:
         query.where_simple(where)
         sql = query.get_query()
 
-        cursor = self.execute(sql, query.placeholder_values)
+        cursor = self.execute_read(sql, query.placeholder_values)
         result = cursor.fetchone()
         cursor.close()
         return result["num_rows"]
@@ -87,7 +411,7 @@ class SQLiteObject:
         query.limit(limit)
         sql = query.get_query()
 
-        cursor = self.execute(sql, placeholder_values)
+        cursor = self.execute_read(sql, placeholder_values)
         result = cursor.fetchone()
         cursor.close()
         return result
@@ -107,7 +431,7 @@ class SQLiteObject:
         query.limit(limit)
         sql = query.get_query()
 
-        cursor = self.execute(sql, query.placeholder_values)
+        cursor = self.execute_read(sql, query.placeholder_values)
         result = cursor.fetchone()
         cursor.close()
         return result
@@ -127,7 +451,7 @@ class SQLiteObject:
         query.limit(limit)
         sql = query.get_query()
 
-        cursor = self.execute(sql, placeholder_values)
+        cursor = self.execute_read(sql, placeholder_values)
         result = cursor.fetchall()
         cursor.close()
         return result
@@ -147,7 +471,7 @@ class SQLiteObject:
         query.limit(limit)
         sql = query.get_query()
 
-        cursor = self.execute(sql, query.get_placeholder_values())
+        cursor = self.execute_read(sql, query.get_placeholder_values())
         result = cursor.fetchall()
         cursor.close()
         return result
@@ -155,14 +479,14 @@ class SQLiteObject:
     def fetchall_query(self, query: str, placeholder_values=None) -> list:
         """using just a query and values returns a list of dicts"""
 
-        cursor = self.execute(query, placeholder_values)
+        cursor = self.execute_read(query, placeholder_values)
         result = cursor.fetchall()
         cursor.close()
         return result
 
     def fetchone_query(self, query: str, placeholder_values=None) -> dict:
         """using just a query and values returns a single dict"""
-        cursor = self.execute(query, placeholder_values)
+        cursor = self.execute_read(query, placeholder_values)
         result = cursor.fetchone()
         cursor.close()
         return result
@@ -205,7 +529,12 @@ class SQLiteObject:
 
     def replace(self, values: dict, where: dict) -> None:
 
-        row = self.fetchone_simple(where=where)
+        # Check on the primary connection. The read replica may be stale
+        query = SQLQuery()
+        query.select(self.get_table()).where_simple(where)
+        cursor = self.execute(query.get_query(), query.get_placeholder_values())
+        row = cursor.fetchone()
+        cursor.close()
         if row:
             self.update_simple(values, where)
         else:
@@ -234,4 +563,4 @@ def get_sqlite_object(db_path) -> SQLiteObject:
     return get_sqlite_object.object
 
 
-__all__ = ["SQLiteObject", "get_sqlite_object"]
+__all__ = ["SQLiteObject", "get_sqlite_object", "is_busy_error"]
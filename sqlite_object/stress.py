@@ -0,0 +1,263 @@
+"""
+Concurrency stress test for SQLiteObject.
+
+Runs a mix of reader and writer threads or processes against a scratch database
+and reports throughput, latency percentiles, busy/locked errors and retries
+for each combination of journal mode and busy timeout.
+
+    python -m sqlite_object.stress --workers 8 32 --journal-modes DELETE WAL
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from sqlite_object.sqlite_object import SQLiteObject, is_busy_error
+
+create_table_sql = """
+CREATE TABLE IF NOT EXISTS stress (
+    stress_id INTEGER PRIMARY KEY,
+    worker INTEGER NOT NULL,
+    title VARCHAR(255) NOT NULL,
+    counter INTEGER DEFAULT 0
+)
+"""
+
+create_index_sql = "CREATE INDEX IF NOT EXISTS idx_stress_worker ON stress (worker)"
+
+
+def setup_database(db_path, journal_mode="WAL", num_rows=1000) -> None:
+    sqlite_object = SQLiteObject(db_path)
+    sqlite_object.execute(f"PRAGMA journal_mode = {journal_mode}")
+    sqlite_object.execute(create_table_sql)
+    sqlite_object.execute(create_index_sql)
+    sqlite_object.set_table("stress")
+
+    def insert_rows():
+        for i in range(num_rows):
+            sqlite_object.insert({"worker": i % 64, "title": f"row {i}"})
+
+    sqlite_object.in_transaction_execute(insert_rows)
+    sqlite_object.close()
+
+
+def run_operation(sqlite_object: SQLiteObject, role, worker, rnd: random.Random):
+    if role == "reader":
+        sqlite_object.fetchall_simple(
+            where={"worker": rnd.randrange(64)}, limit=[0, 20]
+        )
+        return "fetchall_simple"
+
+    choice = rnd.random()
+    if choice < 0.4:
+        sqlite_object.insert({"worker": worker, "title": "insert"})
+        return "insert"
+    if choice < 0.8:
+        sqlite_object.update_simple(
+            values={"counter": rnd.randrange(1000)}, where={"worker": worker}
+        )
+        return "update_simple"
+
+    def transaction():
+        sqlite_object.insert({"worker": worker, "title": "transaction"})
+        sqlite_object.update_simple(values={"counter": 0}, where={"worker": worker})
+
+    sqlite_object.in_transaction_execute(transaction)
+    return "in_transaction_execute"
+
+
+def run_worker(
+    db_path,
+    role,
+    worker,
+    duration,
+    busy_timeout=0,
+    max_retries=10,
+    busy_retries=0,
+    seed=None,
+) -> dict:
+    """
+    Run operations for 'duration' seconds. 'busy_retries' are done by SQLiteObject
+    itself. Busy/locked errors passed on to the worker are retried with
+    exponential backoff up to 'max_retries' times
+    """
+    rnd = random.Random(seed if seed is not None else worker)
+    sqlite_object = SQLiteObject(
+        db_path, busy_timeout=busy_timeout, busy_retries=busy_retries
+    )
+    sqlite_object.set_table("stress")
+
+    result = {
+        "role": role,
+        "ops": 0,
+        "latencies": [],
+        "attempts": 0,
+        "busy_errors": 0,
+        "retries": 0,
+        "failures": 0,
+        "operations": {},
+    }
+
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        start = time.monotonic()
+        for attempt in range(max_retries + 1):
+            result["attempts"] += 1
+            try:
+                operation = run_operation(sqlite_object, role, worker, rnd)
+                break
+            except sqlite3.Error as e:
+                if not is_busy_error(e):
+                    raise
+                result["busy_errors"] += 1
+                if attempt == max_retries:
+                    operation = None
+                    break
+                result["retries"] += 1
+                time.sleep(min(0.001 * 2**attempt, 0.1) * rnd.random())
+
+        if operation is None:
+            result["failures"] += 1
+            continue
+
+        result["latencies"].append(time.monotonic() - start)
+        result["ops"] += 1
+        result["operations"][operation] = result["operations"].get(operation, 0) + 1
+
+    # SQLiteObject counts every busy error, also the ones passed on to the worker
+    busy_stats = sqlite_object.get_busy_stats()
+    result["busy_errors"] = busy_stats["busy_errors"]
+    result["attempts"] += busy_stats["retries"]
+    result["retries"] += busy_stats["retries"]
+
+    sqlite_object.close()
+    return result
+
+
+def percentile(values: list, percent) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(percent / 100 * (len(values) - 1)))]
+
+
+def run_stress(
+    db_path,
+    readers=4,
+    writers=4,
+    duration=5.0,
+    use_processes=False,
+    busy_timeout=0,
+    max_retries=10,
+    busy_retries=0,
+) -> dict:
+    """Run readers and writers against an existing database and return a report"""
+    num_workers = readers + writers
+    roles = ["reader"] * readers + ["writer"] * writers
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+
+    start = time.monotonic()
+    with executor_class(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(
+                run_worker,
+                db_path,
+                role,
+                worker,
+                duration,
+                busy_timeout,
+                max_retries,
+                busy_retries,
+            )
+            for worker, role in enumerate(roles)
+        ]
+        results = [future.result() for future in futures]
+    elapsed = time.monotonic() - start
+
+    report = {
+        "readers": readers,
+        "writers": writers,
+        "processes": use_processes,
+        "busy_timeout": busy_timeout,
+        "busy_retries": busy_retries,
+        "elapsed": elapsed,
+    }
+    for role in ["reader", "writer", "all"]:
+        role_results = [r for r in results if role in ("all", r["role"])]
+        latencies = [latency for r in role_results for latency in r["latencies"]]
+        ops = sum(r["ops"] for r in role_results)
+        attempts = sum(r["attempts"] for r in role_results)
+        busy_errors = sum(r["busy_errors"] for r in role_results)
+        report[role] = {
+            "ops": ops,
+            "throughput": ops / elapsed,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "busy_errors": busy_errors,
+            "busy_rate": busy_errors / attempts if attempts else 0.0,
+            "retries": sum(r["retries"] for r in role_results),
+            "failures": sum(r["failures"] for r in role_results),
+        }
+    return report
+
+
+def format_report(journal_mode, report) -> str:
+    total = report["all"]
+    return (
+        f"{journal_mode:<8} {report['busy_timeout']:>7.3f} "
+        f"{report['readers']:>4}/{report['writers']:<4} "
+        f"{'proc' if report['processes'] else 'thread':<6} "
+        f"{total['throughput']:>10.1f} "
+        f"{total['p50'] * 1000:>8.2f} {total['p95'] * 1000:>8.2f} "
+        f"{total['p99'] * 1000:>8.2f} "
+        f"{total['busy_rate']:>7.2%} {total['retries']:>8} {total['failures']:>8}"
+    )
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[8, 32, 64])
+    parser.add_argument("--write-ratio", type=float, default=0.25)
+    parser.add_argument("--journal-modes", nargs="+", default=["DELETE", "WAL"])
+    parser.add_argument(
+        "--busy-timeouts", type=float, nargs="+", default=[0.0, 0.1, 1.0]
+    )
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--max-retries", type=int, default=10)
+    parser.add_argument("--busy-retries", type=int, default=0)
+    parser.add_argument("--processes", action="store_true")
+    args = parser.parse_args(args)
+
+    print(
+        f"{'journal':<8} {'timeout':>7} {'r/w':<9} {'mode':<6} {'ops/s':>10} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'busy':>7} "
+        f"{'retries':>8} {'failures':>8}"
+    )
+    for journal_mode in args.journal_modes:
+        for busy_timeout in args.busy_timeouts:
+            for num_workers in args.workers:
+                writers = max(1, round(num_workers * args.write_ratio))
+                readers = max(0, num_workers - writers)
+
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    db_path = os.path.join(tmp_dir, "stress.db")
+                    setup_database(db_path, journal_mode)
+                    report = run_stress(
+                        db_path,
+                        readers,
+                        writers,
+                        args.duration,
+                        args.processes,
+                        busy_timeout,
+                        args.max_retries,
+                        args.busy_retries,
+                    )
+                print(format_report(journal_mode, report), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,19 @@ import sys
 
 sys.path.append(".")
 
+import io
+import os
+import sqlite3
+import threading
+import time
 import unittest
 from sqlite3 import Error
 from sqlite_object.sql_query import SQLQuery
 from sqlite_object.sqlite_object import SQLiteObject, get_sqlite_object
+from sqlite_object.maintenance import SQLiteMaintenance
+from sqlite_object.sharded import ShardedSQLiteObject
+from sqlite_object.query_plan import QueryPlanError
+from sqlite_object import stress
 
 create_table_sql = """
 CREATE TABLE IF NOT EXISTS tests (
@@ -269,6 +278,441 @@ class TestSQLiteObject(unittest.TestCase):
 
         sqlite_object.close()
 
+    def test_read_replica(self):
+
+        sqlite_object = get_object("tests")
+        sqlite_object.delete_simple(where={"title": "replica test"})
+        sqlite_object.enable_read_replica()
+
+        sqlite_object.insert(values={"title": "replica test"})
+
+        # The replica is not refreshed yet
+        num_rows = sqlite_object.get_num_rows(where={"title": "replica test"})
+        self.assertEqual(num_rows, 0)
+
+        stats = sqlite_object.get_replica_stats()
+        self.assertTrue(stats["enabled"])
+        self.assertEqual(stats["writes_since_refresh"], 1)
+
+        sqlite_object.refresh_replica()
+        row = sqlite_object.fetchone_simple(where={"title": "replica test"})
+        self.assertEqual(row["title"], "replica test")
+        self.assertEqual(sqlite_object.get_replica_stats()["writes_since_refresh"], 0)
+
+        # replace() must not decide on the stale replica
+        sqlite_object.delete_simple(where={"title": "replica replace"})
+        sqlite_object.replace(
+            values={"title": "replica replace"}, where={"title": "replica replace"}
+        )
+        sqlite_object.replace(
+            values={"title": "replica replace"}, where={"title": "replica replace"}
+        )
+        sqlite_object.refresh_replica()
+        num_rows = sqlite_object.get_num_rows(where={"title": "replica replace"})
+        self.assertEqual(num_rows, 1)
+        sqlite_object.delete_simple(where={"title": "replica replace"})
+
+        # Writes through the query helpers go to the database file
+        row = sqlite_object.fetchone_query(
+            "INSERT INTO tests (title) VALUES (?) RETURNING title", ("replica write",)
+        )
+        self.assertEqual(row["title"], "replica write")
+        sqlite_object.commit()
+        sqlite_object.refresh_replica()
+        num_rows = sqlite_object.get_num_rows(where={"title": "replica write"})
+        self.assertEqual(num_rows, 1)
+        sqlite_object.delete_simple(where={"title": "replica write"})
+
+        with self.assertRaises(sqlite3.OperationalError):
+            sqlite_object.replica.execute("DELETE FROM tests")
+
+        # Refresh on every read
+        sqlite_object.replica_refresh_interval = 0
+        sqlite_object.delete_simple(where={"title": "replica test"})
+        num_rows = sqlite_object.get_num_rows(where={"title": "replica test"})
+        self.assertEqual(num_rows, 0)
+
+        sqlite_object.close()
+
+    @unittest.skipUnless(
+        hasattr(sqlite3.Connection, "blobopen"), "BLOB streaming requires Python 3.11"
+    )
+    def test_blob_stream(self):
+
+        sqlite_object = get_object("blobs")
+        sqlite_object.execute(
+            "CREATE TABLE IF NOT EXISTS blobs (blob_id INTEGER PRIMARY KEY, data BLOB)"
+        )
+        sqlite_object.execute_commit(
+            "INSERT INTO blobs (data) VALUES (zeroblob(?))", (100000,)
+        )
+        rowid = sqlite_object.insert_id()
+
+        payload = bytes(range(256)) * 390
+        written = sqlite_object.write_blob_stream(
+            "blobs", "data", rowid, io.BytesIO(payload), offset=10, chunk_size=4096
+        )
+        self.assertEqual(written, len(payload))
+
+        data = sqlite_object.read_blob_range("blobs", "data", rowid, 10, 256)
+        self.assertEqual(data, payload[:256])
+
+        buffer = bytearray(len(payload))
+        num_read = sqlite_object.read_blob_range(
+            "blobs", "data", rowid, offset=10, buffer=buffer, chunk_size=1000
+        )
+        self.assertEqual(num_read, len(payload))
+        self.assertEqual(bytes(buffer), payload)
+
+        # Blob writes are rolled back with the transaction
+        def test_function():
+            sqlite_object.write_blob_stream("blobs", "data", rowid, io.BytesIO(b"x" * 10))
+            raise Error("rollback")
+
+        with self.assertRaises(Error):
+            sqlite_object.in_transaction_execute(test_function)
+
+        zeros = b"\x00" * 10
+        data = sqlite_object.read_blob_range("blobs", "data", rowid, 0, 10)
+        self.assertEqual(data, zeros)
+
+        # A stream larger than the BLOB is rejected up front
+        with self.assertRaises(ValueError):
+            sqlite_object.write_blob_stream(
+                "blobs", "data", rowid, io.BytesIO(b"x" * 100001)
+            )
+
+        # If the size is unknown a partial write is rolled back
+        class Stream:
+            def __init__(self, data):
+                self.file = io.BytesIO(data)
+
+            def readinto(self, buffer):
+                return self.file.readinto(buffer)
+
+        with self.assertRaises(ValueError):
+            sqlite_object.write_blob_stream(
+                "blobs", "data", rowid, Stream(b"x" * 100001), chunk_size=10
+            )
+        self.assertFalse(sqlite_object.connection.in_transaction)
+        data = sqlite_object.read_blob_range("blobs", "data", rowid, 0, 10)
+        self.assertEqual(data, zeros)
+
+        sqlite_object.delete_simple(where={"blob_id": rowid})
+        sqlite_object.close()
+
+    @unittest.skipIf(hasattr(sqlite3.Connection, "blobopen"), "Python 3.11 or newer")
+    def test_blob_stream_unsupported(self):
+
+        sqlite_object = get_object("tests")
+        with self.assertRaises(Exception):
+            sqlite_object.open_blob("tests", "description", 1)
+        sqlite_object.close()
+
+    def test_maintenance(self):
+
+        db_path = "test_maintenance.db"
+        sqlite_object = SQLiteObject(db_path)
+        sqlite_object.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        sqlite_object.execute("PRAGMA journal_mode = WAL")
+        sqlite_object.execute(create_table_sql)
+        sqlite_object.set_table("tests")
+
+        maintenance = SQLiteMaintenance(db_path, write_limit=2, idle_time=0)
+        sqlite_object.maintenance = maintenance
+        self.assertEqual(maintenance.get_due_steps(), [])
+
+        sqlite_object.insert(values={"title": "maintenance test"})
+        sqlite_object.insert(values={"title": "maintenance test"})
+        self.assertEqual(
+            maintenance.get_due_steps(),
+            ["checkpoint", "optimize", "incremental_vacuum"],
+        )
+
+        report = maintenance.run_if_needed()
+        self.assertEqual(report["checkpoint"]["mode"], "TRUNCATE")
+        self.assertEqual(maintenance.get_wal_size(), 0)
+        self.assertIn("duration", report["optimize"])
+        self.assertIn("reclaimed_bytes", report["incremental_vacuum"])
+        self.assertEqual(maintenance.get_due_steps(), [])
+
+        sqlite_object.close()
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    def test_maintenance_does_not_block_writes(self):
+
+        db_path = "test_maintenance.db"
+        sqlite_object = SQLiteObject(db_path)
+        sqlite_object.execute("PRAGMA journal_mode = WAL")
+        sqlite_object.execute(create_table_sql)
+        sqlite_object.set_table("tests")
+        sqlite_object.insert(values={"title": "maintenance test"})
+
+        maintenance = SQLiteMaintenance(db_path, idle_time=0)
+        sqlite_object.maintenance = maintenance
+
+        # Counting writes does not wait for a running maintenance step
+        with maintenance.connection_lock:
+            maintenance.record_write()
+
+        # An open reader makes the TRUNCATE checkpoint wait on the busy handler
+        reader = sqlite3.connect(db_path)
+        reader.execute("BEGIN")
+        reader.execute("SELECT * FROM tests").fetchall()
+
+        thread = threading.Thread(target=maintenance.run, args=(["checkpoint"],))
+        thread.start()
+        while not maintenance.connection_lock.locked():
+            time.sleep(0.001)
+        time.sleep(0.05)
+
+        start = time.monotonic()
+        sqlite_object.insert(values={"title": "maintenance test"})
+        self.assertTrue(time.monotonic() - start < 1.0)
+
+        thread.join()
+        reader.rollback()
+        reader.close()
+        self.assertTrue(maintenance.last_report["checkpoint"]["busy"])
+
+        sqlite_object.close()
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    def test_maintenance_background(self):
+
+        db_path = "test_maintenance.db"
+        sqlite_object = SQLiteObject(db_path)
+        sqlite_object.execute("PRAGMA journal_mode = WAL")
+        sqlite_object.execute(create_table_sql)
+        sqlite_object.set_table("tests")
+
+        maintenance = sqlite_object.enable_maintenance(interval=0.01, idle_time=0)
+        thread = maintenance.thread
+        self.assertTrue(thread.is_alive())
+
+        sqlite_object.insert(values={"title": "maintenance test"})
+        for _ in range(200):
+            if maintenance.run_count > 0:
+                break
+            time.sleep(0.01)
+        self.assertTrue(maintenance.run_count > 0)
+        self.assertIn("checkpoint", maintenance.get_stats()["last_report"])
+
+        sqlite_object.close()
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(maintenance.thread)
+        self.assertIsNone(sqlite_object.maintenance)
+
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    def test_sharded_sqlite_object(self):
+
+        db_paths = ["test_shard_0.db", "test_shard_1.db", "test_shard_2.db"]
+        for db_path in db_paths:
+            if os.path.exists(db_path):
+                os.remove(db_path)
+
+        sharded = ShardedSQLiteObject(db_paths, shard_key="title")
+        sharded.execute_all(create_table_sql)
+        sharded.set_table("tests")
+
+        titles = [f"shard test {i}" for i in range(10)]
+        for title in titles:
+            sharded.insert(values={"title": title})
+
+        # Rows are spread over more than one shard
+        counts = sharded.run_all(lambda shard: shard.get_num_rows())
+        self.assertEqual(sum(counts), 10)
+        self.assertTrue(len([count for count in counts if count]) > 1)
+
+        row = sharded.fetchone_simple(where={"title": "shard test 3"})
+        self.assertEqual(row["title"], "shard test 3")
+
+        # Positional arguments as in SQLiteObject.fetchone_simple
+        row = sharded.fetchone_simple("*", None, [("title", "ASC")], [2, 1])
+        self.assertEqual(row["title"], "shard test 2")
+
+        rows = sharded.fetchall_simple(order_by=[("title", "DESC")], limit=[1, 3])
+        self.assertEqual([row["title"] for row in rows], titles[::-1][1:4])
+
+        sharded.update_simple(
+            values={"description": "updated"}, where={"title": "shard test 5"}
+        )
+        self.assertEqual(sharded.get_num_rows(where={"description": "updated"}), 1)
+
+        sharded.delete_simple(where={"description": "updated"})
+        self.assertEqual(sharded.get_num_rows(), 9)
+
+        # Mixed types are ordered like SQLite: NULL, numbers, text, BLOBs
+        sharded.execute_all("CREATE TABLE mixed (key INTEGER, value)")
+        sharded.set_table("mixed")
+        sharded.shard_key = "key"
+        values = [b"blob", "b", 10, None, "a", 2.5]
+        for key, value in enumerate(values):
+            sharded.insert(values={"key": key, "value": value})
+
+        rows = sharded.fetchall_simple(order_by=[("value", "ASC")])
+        self.assertEqual(
+            [row["value"] for row in rows], [None, 2.5, 10, "a", "b", b"blob"]
+        )
+
+        sharded.close()
+        for db_path in db_paths:
+            os.remove(db_path)
+
+    def test_plan_guard(self):
+
+        sqlite_object = get_object("plan_tests")
+        sqlite_object.execute(
+            "CREATE TABLE IF NOT EXISTS plan_tests (id INTEGER PRIMARY KEY, title TEXT)"
+        )
+        sqlite_object.delete_simple(where=None)
+        for i in range(10):
+            sqlite_object.insert(values={"title": f"plan test {i}"})
+
+        sqlite_object.enable_plan_guard(mode="raise", min_rows=10)
+
+        # Primary key lookup is fine
+        row = sqlite_object.fetchone_simple(where={"id": 1})
+        self.assertEqual(row["title"], "plan test 0")
+
+        with self.assertRaises(QueryPlanError):
+            sqlite_object.fetchall_simple(where={"title": "plan test 1"})
+
+        with self.assertRaises(QueryPlanError):
+            sqlite_object.fetchall_simple(order_by=[("title", "ASC")])
+
+        # Warnings point at the calling code, for both reads and writes
+        sqlite_object.enable_plan_guard(mode="warn", min_rows=10)
+        with self.assertWarns(UserWarning) as cm:
+            sqlite_object.fetchall_simple(where={"title": "plan test 1"})
+        self.assertEqual(cm.filename, __file__)
+        with self.assertWarns(UserWarning) as cm:
+            sqlite_object.update_simple(
+                values={"title": "plan test 1"}, where={"title": "plan test 1"}
+            )
+        self.assertEqual(cm.filename, __file__)
+
+        plan_guard = sqlite_object.enable_plan_guard(mode="count", min_rows=10)
+        sqlite_object.fetchall_simple(where={"title": "plan test 1"})
+        sqlite_object.fetchall_simple(where={"title": "plan test 2"})
+        stats = plan_guard.get_stats()
+        self.assertEqual(stats["flagged"], 2)
+        self.assertEqual(len(stats["flagged_statements"]), 1)
+
+        # Small tables are not flagged
+        plan_guard = sqlite_object.enable_plan_guard(mode="count", min_rows=15)
+        sqlite_object.fetchall_simple(where={"title": "plan test 1"})
+        self.assertEqual(plan_guard.get_stats()["flagged"], 0)
+
+        # The statement is flagged once the table grows
+        for i in range(10, 20):
+            sqlite_object.insert(values={"title": f"plan test {i}"})
+        sqlite_object.fetchall_simple(where={"title": "plan test 1"})
+        self.assertEqual(plan_guard.get_stats()["flagged"], 1)
+
+        # Aliases are resolved to their tables
+        plan_guard = sqlite_object.enable_plan_guard(mode="count", min_rows=10)
+        sqlite_object.fetchall_query(
+            "SELECT * FROM plan_tests AS x WHERE x.title = ?", ("plan test 1",)
+        )
+        sqlite_object.fetchall_query(
+            "SELECT * FROM plan_tests a JOIN plan_tests b ON b.title = a.title"
+        )
+        self.assertEqual(plan_guard.get_stats()["flagged"], 2)
+
+        sqlite_object.execute("CREATE INDEX idx_title ON plan_tests (title)")
+        plan_guard = sqlite_object.enable_plan_guard(mode="raise", min_rows=10)
+        rows = sqlite_object.fetchall_simple(where={"title": "plan test 1"})
+        self.assertEqual(len(rows), 1)
+
+        sqlite_object.execute("DROP TABLE plan_tests")
+        sqlite_object.close()
+
+    def test_stress(self):
+
+        db_path = "test_stress.db"
+        stress.setup_database(db_path, journal_mode="WAL", num_rows=100)
+        report = stress.run_stress(db_path, readers=2, writers=2, duration=0.2)
+
+        self.assertTrue(report["reader"]["ops"] > 0)
+        self.assertTrue(report["writer"]["ops"] > 0)
+        self.assertEqual(
+            report["all"]["ops"], report["reader"]["ops"] + report["writer"]["ops"]
+        )
+        self.assertTrue(report["all"]["p50"] <= report["all"]["p99"])
+
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    def test_busy_retry(self):
+
+        sqlite_object = SQLiteObject("test.db", busy_timeout=0, busy_retries=2)
+        sqlite_object.set_table("tests")
+
+        # Hold the write lock on another connection
+        lock_connection = sqlite3.connect("test.db", check_same_thread=False)
+        lock_connection.execute("BEGIN IMMEDIATE")
+
+        with self.assertRaises(sqlite3.OperationalError):
+            sqlite_object.insert(values={"title": "busy test"})
+
+        stats = sqlite_object.get_busy_stats()
+        self.assertEqual(stats["busy_errors"], 3)
+        self.assertEqual(stats["retries"], 2)
+
+        # Release the lock while retrying the transaction
+        sqlite_object.busy_retries = 50
+        sqlite_object.busy_backoff_max = 0.02
+        threading.Timer(0.05, lock_connection.rollback).start()
+
+        def test_function():
+            sqlite_object.insert(values={"title": "busy test"})
+
+        sqlite_object.in_transaction_execute(test_function, idempotent=True)
+        self.assertTrue(sqlite_object.get_busy_stats()["transaction_retries"] > 0)
+        self.assertEqual(sqlite_object.get_num_rows(where={"title": "busy test"}), 1)
+
+        sqlite_object.delete_simple(where={"title": "busy test"})
+        lock_connection.close()
+        sqlite_object.close()
+
+    def test_busy_commit_rollback(self):
+
+        sqlite_object = SQLiteObject("test.db", busy_timeout=0, busy_retries=2)
+        sqlite_object.set_table("tests")
+        sqlite_object.delete_simple(where={"title": "busy commit test"})
+
+        # An open reader makes the commit fail in rollback journal mode
+        reader = sqlite3.connect("test.db")
+        # Release the locks if the test fails, so other tests are not blocked
+        self.addCleanup(sqlite_object.connection.close)
+        self.addCleanup(reader.close)
+        reader.execute("BEGIN")
+        reader.execute("SELECT * FROM tests").fetchall()
+
+        with self.assertRaises(sqlite3.OperationalError):
+            sqlite_object.insert(values={"title": "busy commit test"})
+        self.assertFalse(sqlite_object.connection.in_transaction)
+
+        reader.rollback()
+        reader.close()
+
+        # The failed write is not committed by the next write
+        sqlite_object.insert(values={"title": "busy commit test 2"})
+        num_rows = sqlite_object.get_num_rows(where={"title": "busy commit test"})
+        self.assertEqual(num_rows, 0)
+
+        sqlite_object.delete_simple(where={"title": "busy commit test 2"})
+        sqlite_object.close()
+
     def test_sql_query(self):
 
         query = SQLQuery().select("tests").where("title = ? OR title = ?").get_query()